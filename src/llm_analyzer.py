@@ -3,14 +3,168 @@ LLM-based analyzer for extracting delay themes from JIRA comments.
 Uses OpenAI GPT models to identify root causes and sentiment.
 """
 
+import asyncio
+import atexit
+import functools
+import hashlib
+import json
 import os
+import shelve
+import threading
 import time
-from typing import Dict, Optional
-from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+import tiktoken
+from openai import APIConnectionError, BadRequestError, InternalServerError, RateLimitError
 from dotenv import load_dotenv
+from tqdm.auto import tqdm
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+try:
+    from .openai_client import close_async_clients, get_async_client
+except ImportError:
+    # Imported as a top-level module (src/ on sys.path, as in the notebook)
+    from openai_client import close_async_clients, get_async_client
 
 load_dotenv()
 
+# Transient API failures (429s, 5xx, dropped connections and timeouts) are
+# retried with jittered exponential backoff; anything else fails immediately.
+# After the last attempt the original exception is re-raised.
+retry_transient_errors = retry(
+    wait=wait_random_exponential(min=1, max=60),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, InternalServerError)),
+    reraise=True
+)
+
+SENTIMENTS = ('positive', 'neutral', 'negative')
+
+
+class ApproximateEncoding:
+    """
+    Stand-in for a tiktoken encoding when its BPE file cannot be loaded.
+
+    Treats every 4 characters as one token, which is close enough for
+    rate limiting, packing and truncation budgets.
+    """
+
+    CHARS_PER_TOKEN = 4
+
+    def encode(self, text: str) -> List[str]:
+        step = self.CHARS_PER_TOKEN
+        return [text[i:i + step] for i in range(0, len(text), step)]
+
+    def decode(self, tokens: List[str]) -> str:
+        return ''.join(tokens)
+
+
+@functools.lru_cache(maxsize=4)
+def get_encoding(model: str):
+    """
+    Return the (process-wide cached) tiktoken encoding for a model.
+
+    tiktoken downloads the BPE file on first use; if that fails (offline,
+    or the download host is blocked) an ApproximateEncoding is returned
+    instead, since the encoding is only used for estimates.
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            # Model unknown to this tiktoken version; close enough for budgeting
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        print(f"⚠️ Could not load the tokenizer for {model} ({str(e)}); "
+              "estimating token counts from text length")
+        return ApproximateEncoding()
+
+
+@functools.lru_cache(maxsize=None)
+def get_response_cache(path: str) -> Optional[shelve.Shelf]:
+    """
+    Return the process-wide response cache stored at path.
+
+    The store is opened once per process and closed at exit: some dbm
+    backends (gdbm) lock the file, so a second open while the first is
+    alive would fail. If it cannot be opened at all, caching is disabled.
+    """
+    try:
+        cache = shelve.open(path)
+    except Exception as e:
+        print(f"⚠️ Could not open response cache {path} ({str(e)}); caching disabled")
+        return None
+    atexit.register(cache.close)
+    return cache
+
+
+# Guards the shared response caches, which are not thread-safe
+_response_cache_lock = threading.Lock()
+
+
+def run_sync(coro):
+    """
+    Run coro to completion from synchronous code and return its result.
+
+    Inside a running event loop (e.g. a Jupyter cell) asyncio.run() is not
+    allowed, so the coroutine then runs on a fresh loop in a worker thread.
+    The loop's OpenAI clients are closed before it is torn down.
+    """
+    async def run_and_close():
+        try:
+            return await coro
+        finally:
+            await close_async_clients()
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(run_and_close())
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, run_and_close()).result()
+
+
+# Static instructions shared by every request. Keeping them in the system
+# message, ahead of the per-comment text, gives all calls an identical
+# prompt prefix that OpenAI's automatic prompt caching can reuse.
+SYSTEM_PROMPT = """You are an expert project manager analyzing delay root causes.
+
+You are analyzing JIRA issue comments to identify why issues were delayed from October to November.
+
+Analyze the comment you are given and extract:
+1. The PRIMARY delay theme (root cause category)
+2. Sentiment (positive, neutral, negative)
+3. Brief reasoning
+
+If the comment gives no indication of why the issue was delayed, use "Unknown" as the theme.
+
+Respond with a JSON object of this exact shape:
+{"theme": "<brief descriptive theme name>", "sentiment": "<positive/neutral/negative>", \
+"reasoning": "<one sentence explanation>"}"""
+
+# Variant used when several issues are packed into one request.
+PACKED_SYSTEM_PROMPT = """You are an expert project manager analyzing delay root causes.
+
+You are analyzing JIRA issue comments to identify why issues were delayed from October to November.
+
+You will be given the comments of several issues, each introduced by a line of
+the form "=== ISSUE <issue key> ===". For EACH issue, extract:
+1. The PRIMARY delay theme (root cause category)
+2. Sentiment (positive, neutral, negative)
+3. Brief reasoning
+
+If a comment gives no indication of why the issue was delayed, use "Unknown" as its theme.
+
+Respond with a JSON object of this exact shape, with one assignment per issue:
+{"assignments": [{"issue": "<issue key>", "theme": "<brief descriptive theme name>", \
+"sentiment": "<positive/neutral/negative>", "reasoning": "<one sentence explanation>"}]}"""
+
 
 class DelayThemeAnalyzer:
     """Analyzes JIRA comments to extract delay themes using GPT."""
@@ -25,26 +179,333 @@ class DelayThemeAnalyzer:
                 "Copy .env.example to .env and add your API key."
             )
 
-        # Initialize client without deprecated parameters
-        self.client = OpenAI(api_key=self.api_key)
-        self.model = os.getenv('OPENAI_MODEL', 'gpt-4-turbo')
+        # Clients (and their connection pools) are shared across analyzers
+        # and looked up per event loop (see openai_client.get_async_client)
+        self.model = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
+        # Larger model used for issues the default model cannot handle: long
+        # prompts, and replies that fail validation or come back "Unknown"
+        self.fallback_model = os.getenv('OPENAI_FALLBACK_MODEL', 'gpt-4o')
+        self.escalation_prompt_tokens = int(os.getenv('ESCALATION_PROMPT_TOKENS', '3000'))
+        self.escalations = 0
         self.temperature = float(os.getenv('OPENAI_TEMPERATURE', '0.3'))
-        self.max_tokens = int(os.getenv('OPENAI_MAX_TOKENS', '2000'))
+        # Completion budget per issue. The THEME/SENTIMENT/REASONING reply is
+        # well under 100 tokens; latency and TPM accounting scale with the
+        # reserved budget rather than the tokens actually generated.
+        self.max_tokens = int(os.getenv('OPENAI_MAX_TOKENS', '150'))
+        # Model-side cap on one reply (16384 for gpt-4o/gpt-4o-mini); packed
+        # requests reserve max_tokens per issue up to this limit
+        self.max_completion_tokens = int(os.getenv('MAX_COMPLETION_TOKENS', '16384'))
 
-        # Rate limiting
+        # Rate limiting: request and token budgets that refill continuously
         self.requests_per_minute = int(os.getenv('REQUESTS_PER_MINUTE', '20'))
+        self.tokens_per_minute = int(os.getenv('TOKENS_PER_MINUTE', '30000'))
         self.request_interval = 60.0 / self.requests_per_minute
-        self.last_request_time = 0
+        self.available_request_capacity = float(self.requests_per_minute)
+        self.available_token_capacity = float(self.tokens_per_minute)
+        self.last_capacity_update = time.time()
+
+        # Guards the rate-limit budgets, which analyzers driven from several
+        # threads (see run_sync) share
+        self._lock = threading.Lock()
+
+        # Concurrency (batch analysis) and issues packed per request
+        self.max_concurrent_requests = int(os.getenv('MAX_CONCURRENT_REQUESTS', '20'))
+        self.issues_per_request = int(os.getenv('ISSUES_PER_REQUEST', '10'))
+        self.max_prompt_tokens = int(os.getenv('MAX_PROMPT_TOKENS', '8000'))
+        # Per-issue cap on comment tokens in the batch methods (0 disables).
+        # Longer issues keep their first two thirds and last third of it.
+        self.max_comment_tokens = int(os.getenv('MAX_COMMENT_TOKENS', '1500'))
+
+        # Response cache: identical prompts are answered from disk instead of
+        # re-paying for the API call. Set RESPONSE_CACHE_PATH= to disable.
+        # The store is shared by all analyzers using the same path.
+        self.cache_path = os.getenv('RESPONSE_CACHE_PATH', '.theme_cache.db')
+        self._cache = get_response_cache(self.cache_path) if self.cache_path else None
+        if self._cache is not None and self.temperature > 0.5:
+            print(
+                f"⚠️ Response caching is enabled with OPENAI_TEMPERATURE={self.temperature}; "
+                "cached answers will hide run-to-run variation."
+            )
+
+    def _cache_key(self, messages: List[Dict[str, str]], model: str) -> str:
+        """Hash everything that determines the response: model, temperature and prompt."""
+        payload = f"{model}|{self.temperature}|{json.dumps(messages)}"
+        return hashlib.md5(payload.encode('utf-8')).hexdigest()
+
+    def _get_cached(self, cache_key: str) -> Optional[str]:
+        """Return the cached raw response for cache_key, if any."""
+        if self._cache is None:
+            return None
+        with _response_cache_lock:
+            return self._cache.get(cache_key)
+
+    def _set_cached(self, cache_key: str, result_text: str):
+        """Store a successful raw response."""
+        if self._cache is not None:
+            with _response_cache_lock:
+                self._cache[cache_key] = result_text
+
+    def close(self):
+        """Flush the response cache and stop using it (the shared store closes at exit)."""
+        if self._cache is not None:
+            with _response_cache_lock:
+                self._cache.sync()
+            self._cache = None
+
+    @property
+    def encoding(self):
+        """Tokenizer for token estimates, loaded on first use."""
+        return get_encoding(self.model)
+
+    def _estimate_tokens(self, messages: List[Dict[str, str]], max_tokens: int) -> int:
+        """Estimate the TPM cost of a request: prompt tokens plus the reserved completion."""
+        prompt_tokens = sum(len(self.encoding.encode(m['content'])) for m in messages)
+        return prompt_tokens + max_tokens
+
+    def _reserve_capacity(self, token_cost: int) -> float:
+        """
+        Debit one request and token_cost tokens, returning how long to wait.
+        Thread-safe.
+
+        Both budgets refill at their per-minute limit. A request is debited
+        up front, so a negative balance is capacity already promised to
+        earlier callers; the wait is the time until both balances are
+        back to zero. Concurrent callers therefore queue up behind each
+        other instead of all firing at once and hitting 429s.
+        """
+        request_rate = self.requests_per_minute / 60.0
+        token_rate = self.tokens_per_minute / 60.0
+
+        with self._lock:
+            current_time = time.time()
+            elapsed = current_time - self.last_capacity_update
+            self.last_capacity_update = current_time
+
+            self.available_request_capacity = min(
+                self.requests_per_minute,
+                self.available_request_capacity + elapsed * request_rate
+            )
+            self.available_token_capacity = min(
+                self.tokens_per_minute,
+                self.available_token_capacity + elapsed * token_rate
+            )
+
+            self.available_request_capacity -= 1
+            self.available_token_capacity -= min(token_cost, self.tokens_per_minute)
+
+            return max(
+                0.0,
+                -self.available_request_capacity / request_rate,
+                -self.available_token_capacity / token_rate
+            )
+
+    async def _rate_limit(self, token_cost: int):
+        """Wait, yielding to the event loop, until the budgets can cover this call."""
+        wait_time = self._reserve_capacity(token_cost)
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+
+    def _build_messages(self, comment_text: str) -> List[Dict[str, str]]:
+        """Build the chat messages for a single comment analysis."""
+        return [
+            {
+                "role": "system",
+                "content": SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": f"COMMENT:\n{comment_text}"
+            }
+        ]
+
+    def _validate_result(self, data, issue_key: str, raw_response: str) -> Dict[str, str]:
+        """
+        Check one {theme, sentiment, reasoning} object and build the result dict.
+
+        Raises:
+            ValueError: If a field is missing, not a string, or the sentiment
+                is not one of SENTIMENTS
+        """
+        if not isinstance(data, dict):
+            raise ValueError(f"Expected a JSON object for issue {issue_key}")
+
+        for field in ('theme', 'sentiment', 'reasoning'):
+            if not isinstance(data.get(field), str):
+                raise ValueError(f"Missing or invalid '{field}' for issue {issue_key}")
+
+        theme = data['theme'].strip()
+        sentiment = data['sentiment'].strip().lower()
+        if not theme or sentiment not in SENTIMENTS:
+            raise ValueError(f"Invalid theme or sentiment for issue {issue_key}")
+
+        return {
+            'issue_key': issue_key,
+            'theme': theme,
+            'sentiment': sentiment,
+            'reasoning': data['reasoning'].strip(),
+            'raw_response': raw_response
+        }
+
+    def _parse_response(self, result_text: str, issue_key: str) -> Dict[str, str]:
+        """Parse a single-issue JSON response."""
+        return self._validate_result(json.loads(result_text), issue_key, result_text)
+
+    def _build_packed_messages(self, comments: list, issue_keys: list) -> List[Dict[str, str]]:
+        """Build the chat messages for several issues analyzed in one request."""
+        issues_text = "\n\n".join(
+            f"=== ISSUE {key} ===\n{comment}"
+            for comment, key in zip(comments, issue_keys)
+        )
+        return [
+            {
+                "role": "system",
+                "content": PACKED_SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": issues_text
+            }
+        ]
+
+    def _parse_packed_response(self, result_text: str, issue_keys: list) -> List[Dict[str, str]]:
+        """
+        Parse a packed JSON response into one result per issue key.
+
+        Raises:
+            ValueError: If the response is not valid JSON, does not cover
+                every issue key exactly, or an assignment fails validation
+        """
+        assignments = json.loads(result_text).get('assignments')
+        if not isinstance(assignments, list) or not all(isinstance(a, dict) for a in assignments):
+            raise ValueError("Packed response has no list of assignments")
+
+        by_issue = {str(a.get('issue')): a for a in assignments}
+        if set(by_issue) != {str(key) for key in issue_keys}:
+            raise ValueError("Packed response does not match the requested issues")
+
+        return [
+            self._validate_result(by_issue[str(key)], key, json.dumps(by_issue[str(key)]))
+            for key in issue_keys
+        ]
+
+    def _error_result(self, error: Exception, issue_key: str) -> Dict[str, str]:
+        """Build the fallback result returned when an API call or its response fails."""
+        print(f"Error analyzing issue {issue_key}: {str(error)}")
+        # ValueError (incl. JSONDecodeError) comes from response validation
+        kind = 'Invalid Response' if isinstance(error, ValueError) else 'API Error'
+        return {
+            'issue_key': issue_key,
+            'theme': 'Error',
+            'sentiment': 'neutral',
+            'reasoning': f'{kind}: {str(error)}',
+            'raw_response': ''
+        }
+
+    def _request_kwargs(self, messages: List[Dict[str, str]], max_tokens: int,
+                        json_mode: bool, model: str) -> dict:
+        """Build the chat.completions.create arguments."""
+        kwargs = {
+            'model': model,
+            'messages': messages,
+            'temperature': self.temperature,
+            'max_tokens': max_tokens
+        }
+        if json_mode:
+            kwargs['response_format'] = {"type": "json_object"}
+        return kwargs
+
+    @retry_transient_errors
+    async def _call_api(self, request_kwargs: dict):
+        """Call the chat completions API, retrying transient errors."""
+        client = get_async_client(self.api_key)
+        return await client.chat.completions.create(**request_kwargs)
 
-    def _rate_limit(self):
-        """Implement simple rate limiting."""
-        current_time = time.time()
-        time_since_last = current_time - self.last_request_time
+    async def _complete(self, messages: List[Dict[str, str]], max_tokens: int, parse,
+                        json_mode: bool = False, model: Optional[str] = None):
+        """
+        Send messages (or answer them from the cache) and parse the reply.
+
+        The raw response is only cached once parse() accepts it, so a
+        malformed reply is not replayed on the next run. API and parse
+        errors propagate to the caller. model defaults to OPENAI_MODEL;
+        requests actually sent to OPENAI_FALLBACK_MODEL count as escalations.
+        """
+        model = model or self.model
+        cache_key = self._cache_key(messages, model)
+        cached_text = self._get_cached(cache_key)
+        if cached_text is not None:
+            return parse(cached_text)
+
+        await self._rate_limit(self._estimate_tokens(messages, max_tokens))
+        if model == self.fallback_model:
+            self._record_escalation()
+        response = await self._call_api(
+            self._request_kwargs(messages, max_tokens, json_mode, model)
+        )
+
+        result_text = response.choices[0].message.content.strip()
+        result = parse(result_text)
+        self._set_cached(cache_key, result_text)
+        return result
+
+    def _initial_model(self, prompt_tokens: int) -> str:
+        """Pick the model for a single-issue request from its prompt length."""
+        if prompt_tokens > self.escalation_prompt_tokens:
+            return self.fallback_model
+        return self.model
+
+    def _needs_escalation(self, result: Optional[Dict[str, str]], model: str) -> bool:
+        """Whether a default-model result (None if it failed validation) should be retried."""
+        if model == self.fallback_model:
+            return False
+        return result is None or result['theme'].lower() == 'unknown'
+
+    def _next_model(self, result: Optional[Dict[str, str]], error: Optional[Exception],
+                    model: str) -> Optional[str]:
+        """
+        Decide what follows a single-issue request sent to model.
+
+        Returns the model to retry on, or None once result is final. An
+        invalid or "Unknown" default-model reply is retried once on the
+        fallback model; a fallback-model validation error is re-raised.
+        """
+        if self._needs_escalation(result, model):
+            return self.fallback_model
+        if error is not None:
+            raise error
+        return None
 
-        if time_since_last < self.request_interval:
-            time.sleep(self.request_interval - time_since_last)
+    def _record_escalation(self):
+        """Count a request sent to the fallback model."""
+        with self._lock:
+            self.escalations += 1
 
-        self.last_request_time = time.time()
+    def _report_escalations(self, escalations_before: int, total: int):
+        """Print how many issues of a batch needed the fallback model."""
+        escalated = self.escalations - escalations_before
+        if escalated and total:
+            print(f"ℹ️ {escalated} of {total} issues ({escalated / total:.1%}) "
+                  f"escalated to {self.fallback_model}")
+
+    async def _extract(self, comment_text: str, issue_key: str, model: str) -> Dict[str, str]:
+        """Analyze one comment starting on model, escalating as _next_model decides."""
+        messages = self._build_messages(comment_text)
+
+        def parse(text):
+            return self._parse_response(text, issue_key)
+
+        try:
+            while model:
+                try:
+                    result, error = await self._complete(
+                        messages, self.max_tokens, parse, json_mode=True, model=model
+                    ), None
+                except ValueError as e:
+                    result, error = None, e
+                model = self._next_model(result, error, model)
+            return result
+        except Exception as e:
+            return self._error_result(e, issue_key)
 
     def extract_delay_theme(
         self,
@@ -54,6 +515,8 @@ class DelayThemeAnalyzer:
         """
         Extract delay theme and sentiment from a JIRA comment.
 
+        Synchronous wrapper around aextract_delay_theme (see run_sync).
+
         Args:
             comment_text: The JIRA comment text to analyze
             issue_key: JIRA issue identifier for reference
@@ -61,98 +524,252 @@ class DelayThemeAnalyzer:
         Returns:
             Dictionary with theme, sentiment, and reasoning
         """
-        self._rate_limit()
+        return run_sync(self.aextract_delay_theme(comment_text, issue_key))
+
+    async def aextract_delay_theme(
+        self,
+        comment_text: str,
+        issue_key: str = "Unknown"
+    ) -> Dict[str, str]:
+        """
+        Extract delay theme and sentiment from a JIRA comment.
 
-        prompt = f"""You are analyzing JIRA issue comments to identify why issues were delayed from October to November.
+        Args:
+            comment_text: The JIRA comment text to analyze
+            issue_key: JIRA issue identifier for reference
 
-Analyze this comment and extract:
-1. The PRIMARY delay theme (root cause category)
-2. Sentiment (positive, neutral, negative)
-3. Brief reasoning
+        Returns:
+            Dictionary with theme, sentiment, and reasoning. Prompts seen
+            before are answered from the response cache.
 
-COMMENT:
-{comment_text}
+        Comments over ESCALATION_PROMPT_TOKENS go straight to
+        OPENAI_FALLBACK_MODEL; otherwise an invalid or "Unknown" reply from
+        OPENAI_MODEL is retried once on the fallback model.
+        """
+        prompt_tokens = self._estimate_tokens(self._build_messages(comment_text), 0)
+        return await self._extract(comment_text, issue_key, self._initial_model(prompt_tokens))
 
-Respond in this exact format:
-THEME: [brief descriptive theme name]
-SENTIMENT: [positive/neutral/negative]
-REASONING: [one sentence explanation]"""
+    async def _extract_packed(
+        self,
+        comments: list,
+        issue_keys: list,
+        models: list,
+        semaphore: asyncio.Semaphore
+    ) -> list:
+        """
+        Analyze several issues in a single request, holding a concurrency slot.
 
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are an expert project manager analyzing delay root causes."
-                    },
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                temperature=self.temperature,
-                max_tokens=self.max_tokens
-            )
+        models holds each issue's first model (see _initial_models); a lone
+        issue starts on its own, packed issues always use OPENAI_MODEL.
 
-            result_text = response.choices[0].message.content.strip()
-
-            # Parse the response
-            theme = "Unknown"
-            sentiment = "neutral"
-            reasoning = ""
-
-            for line in result_text.split('\n'):
-                line = line.strip()
-                if line.startswith('THEME:'):
-                    theme = line.replace('THEME:', '').strip()
-                elif line.startswith('SENTIMENT:'):
-                    sentiment = line.replace('SENTIMENT:', '').strip().lower()
-                elif line.startswith('REASONING:'):
-                    reasoning = line.replace('REASONING:', '').strip()
-
-            return {
-                'issue_key': issue_key,
-                'theme': theme,
-                'sentiment': sentiment,
-                'reasoning': reasoning,
-                'raw_response': result_text
-            }
+        Falls back to one request per issue if the packed response cannot
+        be parsed or matched to the issues, or the request is rejected as
+        too large; any other API error fails every issue in the chunk.
+        "Unknown" themes in a packed response are retried one by one on
+        the fallback model.
+        """
+        if len(comments) == 1:
+            async with semaphore:
+                return [await self._extract(comments[0], issue_keys[0], models[0])]
 
+        try:
+            async with semaphore:
+                results = await self._complete(
+                    self._build_packed_messages(comments, issue_keys),
+                    min(self.max_tokens * len(comments), self.max_completion_tokens),
+                    lambda text: self._parse_packed_response(text, issue_keys),
+                    json_mode=True
+                )
+        except (ValueError, BadRequestError) as e:
+            print(f"Packed request for {len(comments)} issues failed ({str(e)}); "
+                  "retrying one issue per request")
+            return [
+                result
+                for chunk in await asyncio.gather(*[
+                    self._extract_packed([comment], [key], [model], semaphore)
+                    for comment, key, model in zip(comments, issue_keys, models)
+                ])
+                for result in chunk
+            ]
         except Exception as e:
-            print(f"Error analyzing issue {issue_key}: {str(e)}")
-            return {
-                'issue_key': issue_key,
-                'theme': 'Error',
-                'sentiment': 'neutral',
-                'reasoning': f'API Error: {str(e)}',
-                'raw_response': ''
-            }
+            # Auth failures, exhausted retries etc. would fail per issue too
+            return [self._error_result(e, key) for key in issue_keys]
+
+        async def escalate(comment, key):
+            async with semaphore:
+                return await self._extract(comment, key, self.fallback_model)
+
+        escalated = [
+            i for i, result in enumerate(results) if self._needs_escalation(result, self.model)
+        ]
+        retried = await asyncio.gather(*[escalate(comments[i], issue_keys[i]) for i in escalated])
+        for i, result in zip(escalated, retried):
+            results[i] = result
+        return results
+
+    def _resolve_issue_keys(self, comments: list, issue_keys: Optional[list]) -> list:
+        """Default and validate the issue keys passed to the batch methods."""
+        if issue_keys is None:
+            issue_keys = [f"Issue_{i}" for i in range(len(comments))]
+
+        if len(comments) != len(issue_keys):
+            raise ValueError("Comments and issue_keys must have same length")
+
+        return issue_keys
+
+    def _truncate_comments(self, comments: list) -> tuple:
+        """
+        Cap each comment at max_comment_tokens, keeping its head and tail.
+
+        The head keeps the original context and the tail the latest status
+        update, which is usually the most diagnostic part of a long issue.
+
+        Returns:
+            Tuple of (comments, token_counts, original_token_counts), with
+            token counts measured once here so they can be reused when
+            packing requests and choosing models
+        """
+        truncated_comments, token_counts, original_token_counts = [], [], []
+        n_truncated = 0
+        for comment in comments:
+            tokens = self.encoding.encode(comment)
+            original_token_counts.append(len(tokens))
+            if self.max_comment_tokens and len(tokens) > self.max_comment_tokens:
+                head = self.max_comment_tokens * 2 // 3
+                tail = self.max_comment_tokens - head
+                separator = self.encoding.encode(
+                    f"\n…[truncated {len(tokens) - head - tail} tokens]…\n"
+                )
+                tokens = tokens[:head] + separator + tokens[-tail:]
+                comment = self.encoding.decode(tokens)
+                n_truncated += 1
+            truncated_comments.append(comment)
+            token_counts.append(len(tokens))
+
+        if n_truncated:
+            print(f"ℹ️ Truncated {n_truncated} of {len(comments)} issues "
+                  f"({n_truncated / len(comments):.1%}) to {self.max_comment_tokens} tokens")
+        return truncated_comments, token_counts, original_token_counts
+
+    def _initial_models(self, original_token_counts: List[int]) -> List[str]:
+        """
+        Pick each batch issue's first model from its untruncated prompt length.
+
+        Truncation keeps every batch prompt well under
+        ESCALATION_PROMPT_TOKENS, so the length check has to use the
+        token counts from before it.
+        """
+        prompt_overhead = self._estimate_tokens(self._build_messages(''), 0)
+        return [self._initial_model(prompt_overhead + count) for count in original_token_counts]
+
+    def _pack_ranges(self, token_counts: List[int], issues_per_request: int,
+                     models: List[str]) -> List[tuple]:
+        """
+        Split comments into consecutive (start, end) ranges, one per request.
+
+        Each range holds at most issues_per_request comments totalling no
+        more than max_prompt_tokens; a comment over the budget on its own
+        still gets a request to itself rather than being cut. Issues that
+        start on the fallback model are never packed.
+        """
+        if issues_per_request <= 1:
+            return [(i, i + 1) for i in range(len(token_counts))]
+
+        ranges = []
+        start, used_tokens = 0, 0
+        for i, count in enumerate(token_counts):
+            if i > start and (
+                i - start >= issues_per_request
+                or used_tokens + count > self.max_prompt_tokens
+                or models[start] != self.model
+                or models[i] != self.model
+            ):
+                ranges.append((start, i))
+                start, used_tokens = i, 0
+            used_tokens += count
+
+        if token_counts:
+            ranges.append((start, len(token_counts)))
+        return ranges
 
     def batch_analyze(
         self,
         comments: list,
-        issue_keys: Optional[list] = None
+        issue_keys: Optional[list] = None,
+        *,
+        issues_per_request: Optional[int] = None,
+        max_concurrent_requests: Optional[int] = None,
+        show_progress: bool = True
     ) -> list:
         """
         Analyze multiple comments in batch.
 
+        Synchronous wrapper around abatch_analyze (see run_sync), for
+        callers that cannot await; it takes the same arguments.
+
+        Returns:
+            List of theme analysis results, in the same order as comments
+        """
+        return run_sync(self.abatch_analyze(
+            comments,
+            issue_keys,
+            issues_per_request=issues_per_request,
+            max_concurrent_requests=max_concurrent_requests,
+            show_progress=show_progress
+        ))
+
+    async def abatch_analyze(
+        self,
+        comments: list,
+        issue_keys: Optional[list] = None,
+        *,
+        issues_per_request: Optional[int] = None,
+        max_concurrent_requests: Optional[int] = None,
+        show_progress: bool = True
+    ) -> list:
+        """
+        Analyze multiple comments concurrently.
+
+        Requests are issued through the AsyncOpenAI client with at most
+        max_concurrent_requests in flight, still paced by the
+        REQUESTS_PER_MINUTE and TOKENS_PER_MINUTE limits. In Jupyter, call
+        it with ``await analyzer.abatch_analyze(...)``; elsewhere use
+        batch_analyze. Comments over MAX_COMMENT_TOKENS are cut
+        down to their head and tail first; ESCALATION_PROMPT_TOKENS is still
+        checked against their full length.
+
         Args:
             comments: List of comment texts
             issue_keys: Optional list of issue keys (must match comments length)
+            issues_per_request: Maximum number of comments packed into each
+                API request (default ISSUES_PER_REQUEST); packed requests
+                also stay within MAX_PROMPT_TOKENS
+            max_concurrent_requests: Override for MAX_CONCURRENT_REQUESTS
+            show_progress: Show a progress bar advanced as requests complete
 
         Returns:
-            List of theme analysis results
+            List of theme analysis results, in the same order as comments
         """
-        if issue_keys is None:
-            issue_keys = [f"Issue_{i}" for i in range(len(comments))]
+        issue_keys = self._resolve_issue_keys(comments, issue_keys)
+        issues_per_request = issues_per_request or self.issues_per_request
+        comments, token_counts, original_token_counts = self._truncate_comments(comments)
+        models = self._initial_models(original_token_counts)
+        semaphore = asyncio.Semaphore(max_concurrent_requests or self.max_concurrent_requests)
+        escalations_before = self.escalations
 
-        if len(comments) != len(issue_keys):
-            raise ValueError("Comments and issue_keys must have same length")
+        async def analyze_range(start, end):
+            chunk = await self._extract_packed(
+                comments[start:end], issue_keys[start:end], models[start:end], semaphore
+            )
+            pbar.update(len(chunk))
+            return chunk
 
-        results = []
-        for comment, key in zip(comments, issue_keys):
-            result = self.extract_delay_theme(comment, key)
-            results.append(result)
+        with tqdm(total=len(comments), desc='Analyzing issues', disable=not show_progress) as pbar:
+            chunks = await asyncio.gather(*[
+                analyze_range(start, end)
+                for start, end in self._pack_ranges(token_counts, issues_per_request, models)
+            ])
+        results = [result for chunk in chunks for result in chunk]
 
+        self._report_escalations(escalations_before, len(comments))
         return results
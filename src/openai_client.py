@@ -0,0 +1,35 @@
+"""
+Process-wide OpenAI clients shared by all analyzers.
+Requests reuse one HTTP/2 keep-alive connection pool per API key and event
+loop, so only the first call in a session pays for the TLS handshake.
+"""
+
+import asyncio
+import weakref
+
+import httpx
+from openai import AsyncOpenAI
+
+# Connection pool shared by all requests from one client
+HTTP_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=20)
+HTTP_TIMEOUT = 60.0
+
+# Event loop -> {api_key: client}. An AsyncOpenAI connection pool is bound to
+# the loop it was first used on, so each loop gets its own clients.
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client(api_key: str) -> AsyncOpenAI:
+    """Return the shared async client for api_key on the running event loop."""
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    if api_key not in clients:
+        http_client = httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+        # Retries are handled by the callers (see llm_analyzer.retry_transient_errors)
+        clients[api_key] = AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+    return clients[api_key]
+
+
+async def close_async_clients():
+    """Close the running event loop's clients, e.g. before asyncio.run() tears it down."""
+    for client in _async_clients.pop(asyncio.get_running_loop(), {}).values():
+        await client.close()